@@ -1,5 +1,12 @@
 import os
+import sys
+import stat
+import errno
 import shutil
+import string
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, permutations
 
 from migen.fhdl.structure import Signal
 from migen.genlib.record import Record
@@ -13,10 +20,10 @@ class ConstraintError(Exception):
 
 
 class Pins:
+    __slots__ = ("identifiers",)
+
     def __init__(self, *identifiers):
-        self.identifiers = []
-        for i in identifiers:
-            self.identifiers += i.split()
+        self.identifiers = " ".join(identifiers).split()
 
     def __repr__(self):
         return "{}('{}')".format(self.__class__.__name__,
@@ -24,6 +31,8 @@ class Pins:
 
 
 class IOStandard:
+    __slots__ = ("name",)
+
     def __init__(self, name):
         self.name = name
 
@@ -32,6 +41,8 @@ class IOStandard:
 
 
 class Drive:
+    __slots__ = ("strength",)
+
     def __init__(self, strength):
         self.strength = strength
 
@@ -40,6 +51,8 @@ class Drive:
 
 
 class Misc:
+    __slots__ = ("misc",)
+
     def __init__(self, misc):
         self.misc = misc
 
@@ -48,6 +61,8 @@ class Misc:
 
 
 class Subsignal:
+    __slots__ = ("name", "constraints")
+
     def __init__(self, name, *constraints):
         self.name = name
         self.constraints = list(constraints)
@@ -60,6 +75,8 @@ class Subsignal:
 
 
 class PlatformInfo:
+    __slots__ = ("info",)
+
     def __init__(self, info):
         self.info = info
 
@@ -67,28 +84,30 @@ class PlatformInfo:
         return "{}({})".format(self.__class__.__name__, repr(self.info))
 
 
-def _lookup(description, name, number):
-    for resource in description:
-        if resource[0] == name and (number is None or resource[1] == number):
-            return resource
-    raise ConstraintError("Resource not found: {}:{}".format(name, number))
-
-
 def _resource_type(resource):
     t = None
     for element in resource[2:]:
         if isinstance(element, Pins):
-            assert(t is None)
+            if t is not None:
+                raise ConstraintError(
+                    "Pins must be the only signal of resource {}:{}".format(
+                        resource[0], resource[1]))
             t = len(element.identifiers)
         elif isinstance(element, Subsignal):
             if t is None:
                 t = []
+            elif not isinstance(t, list):
+                raise ConstraintError(
+                    "Pins must be the only signal of resource {}:{}".format(
+                        resource[0], resource[1]))
 
-            assert(isinstance(t, list))
             n_bits = None
             for c in element.constraints:
                 if isinstance(c, Pins):
-                    assert(n_bits is None)
+                    if n_bits is not None:
+                        raise ConstraintError(
+                            "Multiple Pins in subsignal {} of resource {}:{}"
+                            .format(element.name, resource[0], resource[1]))
                     n_bits = len(c.identifiers)
 
             t.append((element.name, n_bits))
@@ -99,8 +118,10 @@ def _resource_type(resource):
 class ConnectorManager:
     def __init__(self):
         self.connector_table = dict()
+        self._resolve_cache = dict()
 
     def add_connectors(self, connectors):
+        self._resolve_cache.clear()
         for connector in connectors:
             cit = iter(connector)
             conn_name = next(cit)
@@ -121,13 +142,19 @@ class ConnectorManager:
             self.connector_table[conn_name] = pin_list
 
     def resolve_identifier(self, identifier):
+        try:
+            return self._resolve_cache[identifier]
+        except KeyError:
+            pass
         if ":" in identifier:
             conn, pn = identifier.split(":")
             if pn.isdigit():
                 pn = int(pn)
-            return self.resolve_identifier(self.connector_table[conn][pn])
+            r = self.resolve_identifier(self.connector_table[conn][pn])
         else:
-            return identifier
+            r = identifier
+        self._resolve_cache[identifier] = r
+        return r
 
     def resolve_identifiers(self, identifiers):
         return [self.resolve_identifier(identifier)
@@ -139,7 +166,9 @@ def _separate_pins(constraints):
     others = []
     for c in constraints:
         if isinstance(c, Pins):
-            assert(pins is None)
+            if pins is not None:
+                # callers add the resource (and subsignal) concerned
+                raise ConstraintError("Multiple Pins")
             pins = c.identifiers
         else:
             others.append(c)
@@ -147,90 +176,234 @@ def _separate_pins(constraints):
     return pins, others
 
 
+class _ParsedResource:
+    def __init__(self, resource):
+        # also rejects top-level Pins mixed with Subsignals, so top_pins
+        # is None whenever there are subsignals
+        self.type = _resource_type(resource)
+        top_constraints = []
+        subsignals = []
+        self.platform_info = None
+        for element in resource[2:]:
+            if isinstance(element, Subsignal):
+                subsignals.append(element)
+            else:
+                if (isinstance(element, PlatformInfo)
+                        and self.platform_info is None):
+                    self.platform_info = element
+                top_constraints.append(element)
+        try:
+            self.top_pins, self.top_others = _separate_pins(top_constraints)
+        except ConstraintError as e:
+            raise ConstraintError("{} in resource {}:{}".format(
+                e, resource[0], resource[1])) from None
+        self.subsignals = []
+        for element in subsignals:
+            try:
+                pins, others = _separate_pins(element.constraints)
+            except ConstraintError as e:
+                raise ConstraintError(
+                    "{} in subsignal {} of resource {}:{}".format(
+                        e, element.name, resource[0], resource[1])) from None
+            self.subsignals.append((element.name, pins,
+                                    self.top_others + others))
+
+
 class ConstraintManager:
     def __init__(self, io, connectors):
-        self.available = list(io)
+        # available resources in declaration order, keyed by id(),
+        # and indexed by (name, number) and by name
+        self._available = OrderedDict()
+        self._by_key = dict()
+        self._by_name = defaultdict(list)
         self.matched = []
+        # parsed resources, keyed by id() of the (live) resource
+        self._parsed = dict()
+        self._matched_by_key = dict()
+        self._matched_by_name = dict()
+        # results derived from matched, dropped whenever it changes
+        self._io_signals = None
+        self._sig_constraints = None
         self.platform_commands = []
+        # parsed platform command templates, see _parse_template()
+        self._command_templates = dict()
         self.connector_manager = ConnectorManager()
         self.connector_manager.add_connectors(connectors)
+        self.add_extension(io)
 
     def add_extension(self, io):
-        self.available.extend(io)
+        for resource in io:
+            # the same resource object can only be requested once
+            if id(resource) in self._available:
+                continue
+            self._available[id(resource)] = resource
+            self._by_key.setdefault((resource[0], resource[1]), resource)
+            self._by_name[resource[0]].append(resource)
+
+    @property
+    def available(self):
+        return list(self._available.values())
+
+    def _lookup(self, name, number):
+        # get() rather than [], so that misses do not grow _by_name
+        if number is None:
+            same_name = self._by_name.get(name)
+            if same_name:
+                return same_name[0]
+        else:
+            resource = self._by_key.get((name, number))
+            if resource is not None:
+                return resource
+        raise ConstraintError("Resource not found: {}:{}".format(name, number))
+
+    def _unindex(self, resource):
+        name, number = resource[0], resource[1]
+        same_name = self._by_name[name]
+        for i, r in enumerate(same_name):
+            if r is resource:
+                del same_name[i]
+                break
+        if not same_name:
+            del self._by_name[name]
+        if self._by_key.get((name, number)) is resource:
+            del self._by_key[(name, number)]
+            # expose the next resource declared with the same name and number
+            for r in same_name:
+                if r[1] == number:
+                    self._by_key[(name, number)] = r
+                    break
+
+    def _parse(self, resource):
+        try:
+            return self._parsed[id(resource)]
+        except KeyError:
+            parsed = _ParsedResource(resource)
+            self._parsed[id(resource)] = parsed
+            return parsed
 
     def add_connectors(self, connectors):
         self.connector_manager.add_connectors(connectors)
+        self._sig_constraints = None
 
     def request(self, name, number=None):
-        resource = _lookup(self.available, name, number)
-        rt = _resource_type(resource)
+        resource = self._lookup(name, number)
+        parsed = self._parse(resource)
+        rt = parsed.type
         if isinstance(rt, int):
             obj = Signal(rt, name_override=resource[0])
         else:
             obj = Record(rt, name=resource[0])
 
-        for element in resource[2:]:
-            if isinstance(element, PlatformInfo):
-                obj.platform_info = element.info
-                break
+        if parsed.platform_info is not None:
+            obj.platform_info = parsed.platform_info.info
 
-        self.available.remove(resource)
+        del self._available[id(resource)]
+        self._unindex(resource)
         self.matched.append((resource, obj))
+        self._matched_by_key.setdefault((resource[0], resource[1]), obj)
+        self._matched_by_name.setdefault(resource[0], obj)
+        self._io_signals = None
+        self._sig_constraints = None
         return obj
 
     def lookup_request(self, name, number=None):
-        for resource, obj in self.matched:
-            if resource[0] == name and (number is None or
-                                        resource[1] == number):
-                return obj
-
-        raise ConstraintError("Resource not found: {}:{}".format(name, number))
+        try:
+            if number is None:
+                return self._matched_by_name[name]
+            else:
+                return self._matched_by_key[(name, number)]
+        except KeyError:
+            raise ConstraintError("Resource not found: {}:{}".format(
+                name, number))
 
     def add_platform_command(self, command, **signals):
+        if command not in self._command_templates:
+            self._command_templates[command] = _parse_template(command)
         self.platform_commands.append((command, signals))
 
     def get_io_signals(self):
-        r = set()
-        for resource, obj in self.matched:
-            if isinstance(obj, Signal):
-                r.add(obj)
-            else:
-                r.update(obj.flatten())
-
-        return r
+        if self._io_signals is None:
+            self._io_signals = frozenset(chain.from_iterable(
+                (obj,) if isinstance(obj, Signal) else obj.flatten()
+                for resource, obj in self.matched))
+        # callers may update the set they get (e.g. verilog.convert)
+        return set(self._io_signals)
 
     def get_sig_constraints(self):
+        if self._sig_constraints is None:
+            self._sig_constraints = self._build_sig_constraints()
+        # fresh pin and constraint lists, so that callers cannot alter
+        # the cached (and parsed resource) ones
+        return [(sig, list(pins), list(others), resource)
+                for sig, pins, others, resource in self._sig_constraints]
+
+    def _build_sig_constraints(self):
         r = []
         for resource, obj in self.matched:
             name = resource[0]
             number = resource[1]
-            has_subsignals = False
-            top_constraints = []
-            for element in resource[2:]:
-                if isinstance(element, Subsignal):
-                    has_subsignals = True
-                else:
-                    top_constraints.append(element)
-
-            if has_subsignals:
-                for element in resource[2:]:
-                    if isinstance(element, Subsignal):
-                        sig = getattr(obj, element.name)
-                        pins, others = _separate_pins(top_constraints +
-                                                      element.constraints)
-                        pins = self.connector_manager.resolve_identifiers(pins)
-                        r.append((sig, pins, others,
-                                  (name, number, element.name)))
+            parsed = self._parse(resource)
+            if parsed.subsignals:
+                for sub_name, pins, others in parsed.subsignals:
+                    sig = getattr(obj, sub_name)
+                    pins = self.connector_manager.resolve_identifiers(pins)
+                    r.append((sig, pins, others, (name, number, sub_name)))
             else:
-                pins, others = _separate_pins(top_constraints)
-                pins = self.connector_manager.resolve_identifiers(pins)
-                r.append((obj, pins, others, (name, number, None)))
+                pins = self.connector_manager.resolve_identifiers(
+                    parsed.top_pins)
+                r.append((obj, pins, parsed.top_others, (name, number, None)))
 
         return r
 
     def get_platform_commands(self):
         return self.platform_commands
 
+    # returns (template, chunks, signals) for each platform command
+    def get_parsed_platform_commands(self):
+        r = []
+        for command, signals in self.platform_commands:
+            try:
+                chunks = self._command_templates[command]
+            except KeyError:
+                # added to platform_commands directly
+                chunks = _parse_template(command)
+                self._command_templates[command] = chunks
+            r.append((command, chunks, signals))
+        return r
+
+
+# splits a platform command template into (literal, field name) chunks, or
+# returns None if it uses more than plain {name} fields and must go through
+# str.format
+def _parse_template(template):
+    chunks = []
+    parsed = string.Formatter().parse(template)
+    try:
+        for literal, field, spec, conversion in parsed:
+            if field is not None and (spec or conversion is not None
+                                      or not field.isidentifier()):
+                return None
+            chunks.append((literal, field))
+    except ValueError:
+        return None
+    return tuple(chunks)
+
+
+_formatter = string.Formatter()
+
+
+# name lookup for platform command templates, resolving only the signals
+# a template actually references
+class _SignalNames:
+    __slots__ = ("signals", "vns")
+
+    def __init__(self, signals, vns):
+        self.signals = signals
+        self.vns = vns
+
+    def __getitem__(self, key):
+        return self.vns.get_name(self.signals[key])
+
 
 class GenericPlatform:
     def __init__(self, device, io, connectors=[], name=None):
@@ -255,10 +428,16 @@ class GenericPlatform:
         raise NotImplementedError
 
     def add_false_path_constraints(self, *clk):
-        for a in clk:
-            for b in clk:
-                if a is not b:
-                    self.add_false_path_constraint(a, b)
+        # constraints are directional (e.g. ISE TIG), so emit both orders;
+        # drop repeated clocks by identity as Signal.__eq__ builds expressions
+        seen = set()
+        unique = []
+        for c in clk:
+            if id(c) not in seen:
+                seen.add(id(c))
+                unique.append(c)
+        for a, b in permutations(unique, 2):
+            self.add_false_path_constraint(a, b)
 
     def add_platform_command(self, *args, **kwargs):
         return self.constraint_manager.add_platform_command(*args, **kwargs)
@@ -306,24 +485,49 @@ class GenericPlatform:
         self.sources.add((os.path.abspath(filename), language, library))
 
     def add_source_dir(self, path, recursive=True, library=None):
-        dir_files = []
-        if recursive:
-            for root, dirs, files in os.walk(path):
-                for filename in files:
-                    dir_files.append(os.path.join(root, filename))
-        else:
-            for item in os.listdir(path):
-                if os.path.isfile(os.path.join(path, item)):
-                    dir_files.append(os.path.join(path, item))
-        for filename in dir_files:
-            language = tools.language_by_filename(filename)
-            if language is not None:
-                self.add_source(filename, language, library)
+        # resolve the working directory once for the whole tree
+        path = os.path.abspath(path)
+        if not recursive:
+            it = os.scandir(path)
+            try:
+                for entry in it:
+                    language = tools.language_by_filename(entry.path)
+                    if language is not None and entry.is_file():
+                        self.add_source(entry.path, language, library)
+            finally:
+                it.close()
+            return
+
+        # same as os.walk: unreadable directories are skipped, symlinked
+        # directories are not descended into and every other entry
+        # (including broken symlinks) counts as a file
+        dirs = [path]
+        while dirs:
+            try:
+                it = os.scandir(dirs.pop())
+            except OSError:
+                continue
+            try:
+                for entry in it:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        if not entry.is_symlink():
+                            dirs.append(entry.path)
+                        continue
+                    language = tools.language_by_filename(entry.path)
+                    if language is not None:
+                        self.add_source(entry.path, language, library)
+            finally:
+                it.close()
 
     # copy all source files to the build_dir to make them
     # self-contained. returns a new set.
     def copy_sources(self, build_dir, subdir="imports"):
         copied_sources = set()
+        copies = dict()
 
         for filename, language, library in self.sources:
             path = _make_local_path(subdir, filename)
@@ -332,12 +536,25 @@ class GenericPlatform:
             src = os.path.join(build_dir, filename)
             # copy to path that starts with build_dir
             dest = os.path.join(build_dir, path)
-            os.makedirs(os.path.dirname(dest), exist_ok=True)
-            shutil.copyfile(src, dest)
+            # one copy per destination, so that no two threads write
+            # the same file
+            copies[dest] = src
 
             # return entries relative to build_dir
             copied_sources.add((path, language, library))
 
+        # create directories up front, copies then run concurrently
+        for dest_dir in {os.path.dirname(dest) for dest in copies}:
+            os.makedirs(dest_dir, exist_ok=True)
+        max_workers = min(32, (os.cpu_count() or 1)*4, len(copies))
+        if max_workers > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                # consume the results to re-raise any copy error
+                list(executor.map(_copy_file, copies.values(), copies))
+        else:
+            for dest, src in copies.items():
+                _copy_file(src, dest)
+
         return copied_sources
 
     def resolve_signals(self, vns):
@@ -346,11 +563,19 @@ class GenericPlatform:
         named_sc = [(vns.get_name(sig), pins, others, resource)
                     for sig, pins, others, resource in sc]
         # resolve signal names in platform commands
-        pc = self.constraint_manager.get_platform_commands()
+        pc = self.constraint_manager.get_parsed_platform_commands()
         named_pc = []
-        for template, args in pc:
-            name_dict = dict((k, vns.get_name(sig)) for k, sig in args.items())
-            named_pc.append(template.format(**name_dict))
+        for template, chunks, args in pc:
+            if chunks is None:
+                # vformat() with no positional arguments, so that "{}"
+                # raises IndexError like template.format(**names) did
+                named_pc.append(_formatter.vformat(
+                    template, (), _SignalNames(args, vns)))
+            else:
+                named_pc.append("".join(
+                    literal if field is None else
+                    literal + vns.get_name(args[field])
+                    for literal, field in chunks))
 
         return named_sc, named_pc
 
@@ -372,15 +597,58 @@ class GenericPlatform:
     def create_programmer(self):
         raise NotImplementedError
 
+# copies the contents of `src` to `dest` with os.sendfile(), as
+# shutil.copyfile() itself does on Linux since Python 3.8
+def _sendfile_copy(src, dest):
+    for fn in (src, dest):
+        try:
+            st = os.stat(fn)
+        except FileNotFoundError:
+            pass
+        else:
+            # opening a named pipe would block
+            if stat.S_ISFIFO(st.st_mode):
+                raise shutil.SpecialFileError(
+                    "`{}` is a named pipe".format(fn))
+
+    with open(src, "rb") as fsrc:
+        src_st = os.fstat(fsrc.fileno())
+        fd = os.open(dest, os.O_WRONLY | os.O_CREAT, 0o666)
+        with open(fd, "wb") as fdest:
+            dest_st = os.fstat(fd)
+            if (src_st.st_dev, src_st.st_ino) == (dest_st.st_dev,
+                                                  dest_st.st_ino):
+                raise shutil.SameFileError(
+                    "{!r} and {!r} are the same file".format(src, dest))
+            os.ftruncate(fd, 0)
+            blocksize = max(src_st.st_size, 1 << 20)
+            offset = 0
+            try:
+                while True:
+                    sent = os.sendfile(fd, fsrc.fileno(), offset, blocksize)
+                    if not sent:
+                        break
+                    offset += sent
+            except OSError as e:
+                # only fall back when sendfile does not support these files,
+                # report real I/O errors (ENOSPC, EIO, ...)
+                if offset or e.errno not in (errno.EINVAL, errno.ENOSYS,
+                                             errno.ENOTSUP):
+                    raise
+                shutil.copyfileobj(fsrc, fdest)
+
+
+if sys.version_info >= (3, 8) or not sys.platform.startswith("linux"):
+    _copy_file = shutil.copyfile
+else:
+    _copy_file = _sendfile_copy
+
+
 # makes potentially absolute `path` local to `subdir`, possibly
 # removing a python path to improve legibility
 def _make_local_path(subdir, path):
-    path_parts = []
-    while True:
-        (path, part) = os.path.split(path)
-        if part == "": break
-        path_parts.append(part)
-    path_parts.reverse()
+    path = os.path.normpath(os.path.splitdrive(path)[1])
+    path_parts = [part for part in path.split(os.sep) if part]
 
     try:
         idx = path_parts.index("site-packages")
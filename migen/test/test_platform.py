@@ -1,11 +1,19 @@
 import os
+import sys
+import errno
+import shutil
 import unittest
 import importlib
 import pkgutil
 import tempfile
+from unittest import mock
 
 from migen import *
 from migen.genlib.cdc import MultiReg
+from migen.build.generic_platform import (GenericPlatform, ConstraintManager,
+                                          ConnectorManager, ConstraintError,
+                                          Pins, IOStandard, Subsignal,
+                                          _sendfile_copy)
 from migen.build.lattice import diamond, icestorm, trellis
 from migen.build.altera import quartus
 from migen.build.xilinx import ise, vivado
@@ -74,3 +82,365 @@ class TestExamplesPlatform(unittest.TestCase):
                               .format(run_toolchain_var, name))
                     plat.build(m, build_name=name, build_dir=temp_dir,
                                run=do_build)
+
+
+class TestConstraintManager(unittest.TestCase):
+    def setUp(self):
+        _io = [
+            ("user_led", 0, Pins("A1"), IOStandard("LVCMOS33")),
+            ("user_led", 1, Pins("A2"), IOStandard("LVCMOS33")),
+            ("serial", 0,
+                Subsignal("tx", Pins("B1")),
+                Subsignal("rx", Pins("B2")),
+                IOStandard("LVCMOS33")
+            ),
+        ]
+        self.cm = ConstraintManager(_io, [])
+
+    def test_request_in_order(self):
+        led0 = self.cm.request("user_led")
+        led1 = self.cm.request("user_led")
+        self.assertIs(self.cm.lookup_request("user_led"), led0)
+        self.assertIs(self.cm.lookup_request("user_led", 1), led1)
+        with self.assertRaises(ConstraintError):
+            self.cm.request("user_led")
+
+    def test_request_by_number(self):
+        led1 = self.cm.request("user_led", 1)
+        with self.assertRaises(ConstraintError):
+            self.cm.request("user_led", 1)
+        self.assertIsNot(self.cm.request("user_led"), led1)
+        with self.assertRaises(ConstraintError):
+            self.cm.lookup_request("serial")
+
+    def test_request_missing(self):
+        for number in [None, 0]:
+            with self.assertRaises(ConstraintError):
+                self.cm.request("osch_clk", number)
+        self.assertNotIn("osch_clk", self.cm._by_name)
+        self.assertEqual(len(self.cm.available), 3)
+
+    def test_extension(self):
+        self.cm.add_extension([("user_led", 2, Pins("A3"))])
+        self.cm.request("user_led", 2)
+        self.assertEqual(len(self.cm.available), 3)
+
+    def test_available_order(self):
+        self.cm.add_extension([("user_led", n, Pins("C{}".format(n)))
+                               for n in range(2, 40)])
+        self.cm.request("user_led", 1)
+        self.assertEqual([(r[0], r[1]) for r in self.cm.available],
+                         [("user_led", 0), ("serial", 0)] +
+                         [("user_led", n) for n in range(2, 40)])
+
+    def test_extension_same_object(self):
+        led = ("user_led", 2, Pins("A3"))
+        self.cm.add_extension([led])
+        self.cm.add_extension([led])
+        self.assertEqual(len(self.cm.available), 4)
+        self.cm.request("user_led", 2)
+        self.assertEqual(len(self.cm.available), 3)
+        with self.assertRaises(ConstraintError):
+            self.cm.request("user_led", 2)
+
+    def test_sig_constraints(self):
+        led = self.cm.request("user_led", 1)
+        serial = self.cm.request("serial")
+        sc = self.cm.get_sig_constraints()
+        self.assertEqual([(sig, pins, [repr(o) for o in others], res)
+                          for sig, pins, others, res in sc], [
+            (led, ["A2"], ["IOStandard('LVCMOS33')"], ("user_led", 1, None)),
+            (serial.tx, ["B1"], ["IOStandard('LVCMOS33')"],
+                ("serial", 0, "tx")),
+            (serial.rx, ["B2"], ["IOStandard('LVCMOS33')"],
+                ("serial", 0, "rx")),
+        ])
+        self.assertEqual(self.cm.get_io_signals(),
+                         {led, serial.tx, serial.rx})
+
+    def test_cached_results_follow_requests(self):
+        led = self.cm.request("user_led")
+        self.assertEqual(self.cm.get_io_signals(), {led})
+        self.assertEqual(len(self.cm.get_sig_constraints()), 1)
+        serial = self.cm.request("serial")
+        self.assertEqual(self.cm.get_io_signals(),
+                         {led, serial.tx, serial.rx})
+        self.assertEqual(len(self.cm.get_sig_constraints()), 3)
+
+    def test_sig_constraints_are_copies(self):
+        self.cm.request("user_led")
+        sig, pins, others, resource = self.cm.get_sig_constraints()[0]
+        pins.append("junk")
+        others.append("junk")
+        self.cm.get_io_signals().clear()
+        sig, pins, others, resource = self.cm.get_sig_constraints()[0]
+        self.assertEqual(pins, ["A1"])
+        self.assertEqual([repr(o) for o in others],
+                         ["IOStandard('LVCMOS33')"])
+        self.assertEqual(self.cm.get_io_signals(), {sig})
+
+    def test_malformed_resource(self):
+        self.cm.add_extension([
+            ("bad", 0, Pins("C1"), Subsignal("a", Pins("C2"))),
+            ("bad", 1, Subsignal("a", Pins("C3"), Pins("C4"))),
+            ("bad", 2, Subsignal("a", Pins("C5")), Pins("C6")),
+        ])
+        for number in range(3):
+            with self.assertRaises(ConstraintError):
+                self.cm.request("bad", number)
+
+
+class TestConnectorManager(unittest.TestCase):
+    def test_resolve(self):
+        cm = ConnectorManager()
+        cm.add_connectors([
+            ("J1", "A1 A2 None A4"),
+            ("J2", {"clk": "J1:1", "d0": "J1:3"}),
+        ])
+        self.assertEqual(
+            cm.resolve_identifiers(["J1:0", "J2:clk", "J2:d0", "C5"]),
+            ["A1", "A2", "A4", "C5"])
+        self.assertEqual(cm.resolve_identifier("J2:clk"), "A2")
+        with self.assertRaises(ValueError):
+            cm.add_connectors([("J1", "B1")])
+        cm.add_connectors([("J3", "J2:d0 B2")])
+        self.assertEqual(cm.resolve_identifiers(["J3:0", "J3:1"]),
+                         ["A4", "B2"])
+
+    def test_pin_numbers(self):
+        cm = ConnectorManager()
+        cm.add_connectors([
+            ("J1", "A1 A2", "A3"),
+            ("J2", {3: "J1:02", "2": "B2"}),
+        ])
+        self.assertEqual(cm.connector_table["J1"], ["A1", "A2", "A3"])
+        self.assertEqual(cm.resolve_identifiers(["J1:02", "J2:3", "J2:03"]),
+                         ["A3", "A3", "A3"])
+        with self.assertRaises(IndexError):
+            cm.resolve_identifier("J1:3")
+        # digit pin names are looked up as integers
+        with self.assertRaises(KeyError):
+            cm.resolve_identifier("J2:2")
+
+
+class TestFalsePaths(unittest.TestCase):
+    def test_order(self):
+        pairs = []
+
+        class _Platform(GenericPlatform):
+            def add_false_path_constraint(self, from_, to):
+                pairs.append((from_, to))
+
+        clk = [Signal(name_override="clk{}".format(i)) for i in range(8)]
+        _Platform("dev", [], name="test").add_false_path_constraints(
+            *(clk + clk[:2]))
+        self.assertEqual(
+            [(a.name_override, b.name_override) for a, b in pairs],
+            [(a.name_override, b.name_override)
+             for a in clk for b in clk if a is not b])
+
+
+class TestSources(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        os.makedirs(os.path.join(self.root, "rtl", "sub"))
+        for name in ["top.v", "notes.txt", os.path.join("sub", "core.vhd")]:
+            with open(os.path.join(self.root, "rtl", name), "w") as f:
+                f.write(name)
+        self.plat = GenericPlatform("dev", [], name="test")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _sources(self):
+        return sorted((os.path.relpath(filename, self.root), language)
+                      for filename, language, library in self.plat.sources)
+
+    def test_add_source_dir(self):
+        rtl = os.path.join(self.root, "rtl")
+        self.plat.add_source_dir(rtl, recursive=False)
+        self.assertEqual(self._sources(),
+                         [(os.path.join("rtl", "top.v"), "verilog")])
+        self.plat.add_source_dir(rtl)
+        self.assertEqual(self._sources(), [
+            (os.path.join("rtl", "sub", "core.vhd"), "vhdl"),
+            (os.path.join("rtl", "top.v"), "verilog"),
+        ])
+
+    def test_add_source_dir_extension_names(self):
+        # files named like an extension have no extension themselves
+        rtl = os.path.join(self.root, "rtl")
+        for name in ["v", "vhdl"]:
+            with open(os.path.join(rtl, name), "w") as f:
+                f.write(name)
+        for recursive in [False, True]:
+            with self.subTest(recursive=recursive):
+                self.plat.sources.clear()
+                self.plat.add_source_dir(rtl, recursive=recursive)
+                self.assertNotIn(os.path.join("rtl", "v"),
+                                 [f for f, l in self._sources()])
+                self.assertNotIn(os.path.join("rtl", "vhdl"),
+                                 [f for f, l in self._sources()])
+
+    def test_add_source_dir_missing(self):
+        missing = os.path.join(self.root, "missing")
+        # like os.walk, recursive scans skip unreadable directories
+        self.plat.add_source_dir(missing)
+        self.assertEqual(self.plat.sources, set())
+        with self.assertRaises(FileNotFoundError):
+            self.plat.add_source_dir(missing, recursive=False)
+
+    def _copied_data(self, build_dir, copied):
+        r = []
+        for path, language, library in copied:
+            self.assertTrue(path.startswith("imports" + os.sep))
+            with open(os.path.join(build_dir, path)) as f:
+                r.append((f.read(), language))
+        return sorted(r)
+
+    def test_copy_sources(self):
+        self.plat.add_source_dir(os.path.join(self.root, "rtl"))
+        build_dir = os.path.join(self.root, "build")
+        copied = self.plat.copy_sources(build_dir)
+        expected = [(os.path.join("sub", "core.vhd"), "vhdl"),
+                    ("top.v", "verilog")]
+        self.assertEqual(self._copied_data(build_dir, copied), expected)
+        # copying again overwrites the previous copies
+        self.assertEqual(self.plat.copy_sources(build_dir), copied)
+        self.assertEqual(self._copied_data(build_dir, copied), expected)
+
+    def test_copy_sources_many(self):
+        rtl = os.path.join(self.root, "rtl")
+        expected = []
+        for i in range(20):
+            name = "mod{}.v".format(i)
+            with open(os.path.join(rtl, name), "w") as f:
+                f.write(name)
+            expected.append((name, "verilog"))
+        self.plat.add_source_dir(rtl, recursive=False)
+        build_dir = os.path.join(self.root, "build")
+        copied = self.plat.copy_sources(build_dir)
+        self.assertEqual(self._copied_data(build_dir, copied),
+                         sorted(expected + [("top.v", "verilog")]))
+
+    def test_copy_sources_same_destination(self):
+        top = os.path.join(self.root, "rtl", "top.v")
+        self.plat.add_source(top, library="work")
+        self.plat.add_source(top, library="other")
+        build_dir = os.path.join(self.root, "build")
+        copied = self.plat.copy_sources(build_dir)
+        self.assertEqual(sorted(library for _, _, library in copied),
+                         ["other", "work"])
+        self.assertEqual(self._copied_data(build_dir, copied),
+                         [("top.v", "verilog")]*2)
+
+    def test_copy_sources_error(self):
+        self.plat.add_source_dir(os.path.join(self.root, "rtl"))
+        self.plat.add_source(os.path.join(self.root, "missing.v"))
+        with self.assertRaises(FileNotFoundError):
+            self.plat.copy_sources(os.path.join(self.root, "build"))
+
+    @unittest.skipUnless(hasattr(os, "symlink"), "no symlinks")
+    def test_add_source_dir_broken_symlink(self):
+        rtl = os.path.join(self.root, "rtl")
+        os.symlink(os.path.join(self.root, "missing.v"),
+                   os.path.join(rtl, "broken.v"))
+        self.plat.add_source_dir(rtl, recursive=False)
+        self.assertNotIn(os.path.join("rtl", "broken.v"),
+                         [f for f, l in self._sources()])
+        self.plat.add_source_dir(rtl)
+        self.assertIn((os.path.join("rtl", "broken.v"), "verilog"),
+                      self._sources())
+
+
+@unittest.skipUnless(hasattr(os, "sendfile")
+                     and sys.platform.startswith("linux"), "no os.sendfile")
+class TestSendfileCopy(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmp.name, "src.v")
+        self.dest = os.path.join(self.tmp.name, "dest.v")
+        self.data = bytes(range(256))*5000
+        with open(self.src, "wb") as f:
+            f.write(self.data)
+        with open(self.dest, "wb") as f:
+            f.write(b"stale contents, longer than nothing")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _dest_data(self):
+        with open(self.dest, "rb") as f:
+            return f.read()
+
+    def test_copy(self):
+        _sendfile_copy(self.src, self.dest)
+        self.assertEqual(self._dest_data(), self.data)
+
+    def test_same_file(self):
+        with self.assertRaises(shutil.SameFileError):
+            _sendfile_copy(self.src, self.src)
+        with open(self.src, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+    @unittest.skipUnless(hasattr(os, "mkfifo"), "no named pipes")
+    def test_fifo(self):
+        fifo = os.path.join(self.tmp.name, "fifo.v")
+        os.mkfifo(fifo)
+        with self.assertRaises(shutil.SpecialFileError):
+            _sendfile_copy(fifo, self.dest)
+
+    def test_unsupported_fallback(self):
+        error = OSError(errno.EINVAL, "sendfile not supported")
+        with mock.patch("os.sendfile", side_effect=error):
+            _sendfile_copy(self.src, self.dest)
+        self.assertEqual(self._dest_data(), self.data)
+
+    def test_io_error(self):
+        error = OSError(errno.ENOSPC, "no space left on device")
+        with mock.patch("os.sendfile", side_effect=error):
+            with self.assertRaises(OSError) as cm:
+                _sendfile_copy(self.src, self.dest)
+        self.assertEqual(cm.exception.errno, errno.ENOSPC)
+
+
+class TestPlatformCommands(unittest.TestCase):
+    def setUp(self):
+        self.plat = GenericPlatform("dev", [
+            ("clk", 0, Pins("A1")),
+            ("led", 0, Pins("A2")),
+        ], name="test")
+        self.clk = self.plat.request("clk")
+        self.led = self.plat.request("led")
+
+    def _resolve(self):
+        m = Module()
+        m.comb += self.led.eq(self.clk)
+        v_output = self.plat.get_verilog(m)
+        return self.plat.resolve_signals(v_output.ns)[1]
+
+    def test_fields(self):
+        self.plat.add_platform_command("set {clk} {{literal}} {led}{clk}",
+                                       clk=self.clk, led=self.led)
+        self.plat.add_platform_command("plain")
+        self.plat.add_platform_command("{clk!r} [{led:>5}]",
+                                       clk=self.clk, led=self.led)
+        self.plat.constraint_manager.platform_commands.append(
+            ("direct {led}", {"led": self.led}))
+        self.assertEqual(self._resolve(), [
+            "set clk {literal} ledclk",
+            "plain",
+            "'clk' [  led]",
+            "direct led",
+        ])
+
+    def test_errors(self):
+        for template, error in [("{}", IndexError),
+                                ("set {", ValueError),
+                                ("{missing}", KeyError)]:
+            with self.subTest(template=template):
+                self.plat.constraint_manager.platform_commands.clear()
+                self.plat.add_platform_command(template, clk=self.clk)
+                with self.assertRaises(error):
+                    self._resolve()